@@ -1,119 +1,198 @@
 import os
-import json
-from typing import List, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pdf_processor import PDFProcessor
+from typing import List, Dict, Any, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pdf_processor import PDFProcessor, _default_workers, _dump_json_bytes
 
-class BatchPDFProcessor:
-    def __init__(self, max_workers: int = 4):
-        self.processor = PDFProcessor()
-        self.max_workers = max_workers
-        
-    def _normalize_raster_results(self, results: Dict) -> Dict[str, Any]:
-        """Normalize raster processing results to a standard format"""
-        return {
-            "type": "raster",
-            "total_pages": results["total_pages"],
-            "processed_files": [
-                {
-                    "page_number": i + 1,
-                    "file_path": path,
-                    "file_type": "image"
-                }
-                for i, path in enumerate(results["processed_images"])
-            ]
-        }
-    
-    def _normalize_vector_results(self, results: Dict) -> Dict[str, Any]:
-        """Normalize vector processing results to a standard format"""
+# msgpack is optional; it only enables the binary output format
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Leave a couple of cores free for the parent process driving the pool
+_PARENT_RESERVED_CORES = 2
+
+def _normalize_raster_results(results: Dict) -> Dict[str, Any]:
+    """Normalize raster processing results to a standard format"""
+    return {
+        "type": "raster",
+        "total_pages": results["total_pages"],
+        "processed_files": [
+            {
+                "page_number": i + 1,
+                "file_path": path,
+                "file_type": "image"
+            }
+            for i, path in enumerate(results["processed_images"])
+            if path is not None
+        ]
+    }
+
+def _normalize_vector_results(results: Dict) -> Dict[str, Any]:
+    """Normalize vector processing results to a standard format"""
+    # Coerce PyPDF2's DocumentInformation to a plain dict: its keys/values
+    # are generic objects (NameObject, ByteStringObject, IndirectObject...)
+    # that orjson and msgpack refuse even where stdlib json happens to cope
+    metadata = results["metadata"]
+    metadata = ({str(k): str(v) for k, v in metadata.items()}
+                if metadata else {})
+    return {
+        "type": "vector",
+        "total_pages": results["total_pages"],
+        "processed_files": [
+            {
+                "page_number": i + 1,
+                "file_path": "pages.jsonl",
+                "file_type": "text",
+                "content_length": len(text)
+            }
+            for i, text in enumerate(results["text_content"])
+        ],
+        "metadata": metadata
+    }
+
+def _process_single_pdf(pdf_path: str, output_dir: str,
+                        page_workers: Optional[int] = None) -> Dict[str, Any]:
+    """Process one PDF and return normalized results (top-level so it can be
+    pickled for worker processes)"""
+    # Compute the name parts once; the error path reuses them
+    pdf_basename = os.path.basename(pdf_path)
+    pdf_name = os.path.splitext(pdf_basename)[0]
+    try:
+        # Create a subdirectory for this PDF
+        pdf_output_dir = os.path.join(output_dir, pdf_name)
+        os.makedirs(pdf_output_dir, exist_ok=True)
+
+        # Each worker builds its own processor; cached readers are not
+        # fork-safe to share across processes
+        if page_workers is not None:
+            processor = PDFProcessor(max_workers=page_workers)
+        else:
+            processor = PDFProcessor()
+
+        # Process the PDF
+        pdf_type, results = processor.process_pdf(pdf_path, pdf_output_dir)
+
+        # Normalize results
+        if pdf_type == "raster":
+            normalized_results = _normalize_raster_results(results)
+        else:
+            normalized_results = _normalize_vector_results(results)
+
+        # Add PDF information
+        normalized_results["pdf_name"] = pdf_name
+        normalized_results["pdf_path"] = pdf_path
+
+        return normalized_results
+
+    except Exception as e:
         return {
-            "type": "vector",
-            "total_pages": results["total_pages"],
-            "processed_files": [
-                {
-                    "page_number": i + 1,
-                    "file_path": f"page_{i+1}_text.txt",
-                    "file_type": "text",
-                    "content_length": len(text)
-                }
-                for i, text in enumerate(results["text_content"])
-            ],
-            "metadata": results["metadata"] if results["metadata"] else {}
+            "pdf_name": pdf_basename,
+            "pdf_path": pdf_path,
+            "error": str(e)
         }
-    
+
+class BatchPDFProcessor:
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers if max_workers is not None else _default_workers()
+
     def process_single_pdf(self, pdf_path: str, output_dir: str) -> Dict[str, Any]:
         """Process a single PDF and return normalized results"""
-        try:
-            # Create a subdirectory for this PDF
-            pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-            pdf_output_dir = os.path.join(output_dir, pdf_name)
-            os.makedirs(pdf_output_dir, exist_ok=True)
-            
-            # Process the PDF
-            pdf_type, results = self.processor.process_pdf(pdf_path, pdf_output_dir)
-            
-            # Normalize results
-            if pdf_type == "raster":
-                normalized_results = self._normalize_raster_results(results)
-            else:
-                normalized_results = self._normalize_vector_results(results)
-            
-            # Add PDF information
-            normalized_results["pdf_name"] = pdf_name
-            normalized_results["pdf_path"] = pdf_path
-            
-            return normalized_results
-            
-        except Exception as e:
-            return {
-                "pdf_name": os.path.basename(pdf_path),
-                "pdf_path": pdf_path,
-                "error": str(e)
-            }
-    
-    def process_directory(self, input_dir: str, output_dir: str) -> Dict[str, Any]:
-        """Process all PDFs in a directory and return combined results"""
-        # Find all PDF files
-        pdf_files = [
-            os.path.join(input_dir, f)
-            for f in os.listdir(input_dir)
-            if f.lower().endswith('.pdf')
-        ]
-        
+        return _process_single_pdf(pdf_path, output_dir)
+
+    def process_directory(self, input_dir: str, output_dir: str,
+                          output_format: str = "json") -> Dict[str, Any]:
+        """Process all PDFs in a directory and return combined results.
+
+        output_format selects the results file: "json" (human-readable,
+        default) or "msgpack" (binary, much smaller and faster to parse)
+        """
+        if output_format not in ("json", "msgpack"):
+            raise ValueError(f"Unknown output format: {output_format}")
+        if output_format == "msgpack" and msgpack is None:
+            raise ImportError("msgpack is required for output_format='msgpack'")
+
+        # Find all PDF files; scandir reuses the directory entry's cached
+        # type info, so no extra stat per file
+        with os.scandir(input_dir) as entries:
+            pdf_files = [
+                entry.path
+                for entry in entries
+                if entry.is_file() and entry.name.endswith(('.pdf', '.PDF'))
+            ]
+
         if not pdf_files:
             return {"error": "No PDF files found in the input directory"}
-        
-        # Process PDFs in parallel
+
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir,
+                                   "processing_results." + output_format)
+
+        # The natural parallel axis for a batch is across PDFs, so the outer
+        # pool uses processes; slice the remaining cores between the workers
+        # so outer * inner stays around the core count rather than squaring it
+        cpu = os.cpu_count() or 2
+        pool_workers = min(self.max_workers,
+                           max(1, cpu - _PARENT_RESERVED_CORES),
+                           len(pdf_files))
+        page_workers = max(1, cpu // pool_workers)
+
+        # Process PDFs in parallel, streaming each result into the output
+        # file as it completes instead of accumulating one big dict and
+        # dumping it. The msgpack stream is framed as a header map, one map
+        # per PDF, then a trailer map with the counters - read it back with
+        # msgpack.Unpacker.
         results = []
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        successful = 0
+        failed = 0
+        packer = (msgpack.Packer(use_bin_type=True)
+                  if output_format == "msgpack" else None)
+        with open(output_file, 'wb', buffering=1 << 20) as f, \
+                ProcessPoolExecutor(max_workers=pool_workers) as executor:
+            if packer is not None:
+                f.write(packer.pack({"total_pdfs": len(pdf_files)}))
+            else:
+                f.write(b'{"total_pdfs": %d, "results": [' % len(pdf_files))
+
             future_to_pdf = {
-                executor.submit(self.process_single_pdf, pdf_path, output_dir): pdf_path
+                executor.submit(_process_single_pdf, pdf_path, output_dir, page_workers): pdf_path
                 for pdf_path in pdf_files
             }
-            
+
             for future in as_completed(future_to_pdf):
                 pdf_path = future_to_pdf[future]
                 try:
                     result = future.result()
-                    results.append(result)
                 except Exception as e:
-                    results.append({
+                    result = {
                         "pdf_name": os.path.basename(pdf_path),
                         "pdf_path": pdf_path,
                         "error": str(e)
-                    })
-        
-        # Create summary
-        summary = {
+                    }
+
+                if "error" in result:
+                    failed += 1
+                else:
+                    successful += 1
+
+                if packer is not None:
+                    f.write(packer.pack(result))
+                else:
+                    if results:
+                        f.write(b",")
+                    f.write(_dump_json_bytes(result))
+                results.append(result)
+
+            if packer is not None:
+                f.write(packer.pack({"successful_processing": successful,
+                                     "failed_processing": failed}))
+            else:
+                f.write(b'], "successful_processing": %d, "failed_processing": %d}'
+                        % (successful, failed))
+
+        return {
             "total_pdfs": len(pdf_files),
-            "successful_processing": len([r for r in results if "error" not in r]),
-            "failed_processing": len([r for r in results if "error" in r]),
+            "successful_processing": successful,
+            "failed_processing": failed,
             "results": results
         }
-        
-        # Save results to JSON file
-        output_file = os.path.join(output_dir, "processing_results.json")
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, indent=2)
-        
-        return summary 
\ No newline at end of file
@@ -31,7 +31,8 @@ def process_single_pdf():
         if pdf_type == 'raster':
             print("\nProcessed Images:")
             for img_path in results['processed_images']:
-                print(f"- {img_path}")
+                if img_path is not None:
+                    print(f"- {img_path}")
         else:
             print("\nExtracted Text Files:")
             for i, text in enumerate(results['text_content']):
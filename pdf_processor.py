@@ -1,119 +1,255 @@
 import os
+import json
+import mmap
+import queue
+import threading
 from typing import Tuple, Dict, List, Optional
 import cv2
 import numpy as np
 from PyPDF2 import PdfReader
 from PIL import Image
-import io
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 import time
 from tqdm import tqdm
 
+# Prefer orjson's C serializer when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Numba is optional; it only accelerates the background-uniformity probe
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Prefer pypdfium2's native renderer; fall back to pdf2image (Poppler)
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    from pdf2image import convert_from_path
+except ImportError:
+    convert_from_path = None
+
+def _default_workers() -> int:
+    """Default worker count: every core but one, so the host stays responsive"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+def _dump_json_bytes(obj) -> bytes:
+    """Serialize to JSON bytes, via orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+# Files above this size are read through a buffer instead of mapped whole
+_MMAP_MAX_BYTES = 256 << 20
+
+def _open_pdf_stream(pdf_path: str):
+    """Open a PDF for PdfReader; memory-map it so the random xref seeks hit
+    the page cache instead of issuing small read syscalls"""
+    if os.path.getsize(pdf_path) < _MMAP_MAX_BYTES:
+        with open(pdf_path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return open(pdf_path, 'rb', buffering=1 << 20)
+
+@lru_cache(maxsize=8)
+def _open_pdf_reader(pdf_path: str) -> PdfReader:
+    """Open a PdfReader, cached so each worker process parses a PDF once"""
+    return PdfReader(_open_pdf_stream(pdf_path))
+
+@lru_cache(maxsize=8)
+def _open_pdf_document(pdf_path: str):
+    """Open a pypdfium2 document, cached so each worker process parses a PDF once"""
+    return pdfium.PdfDocument(pdf_path)
+
+def _convert_pdf_page_to_image(pdf_path: str, page_num: int = 0) -> Image.Image:
+    """Rasterize a PDF page to a PIL image using a native renderer"""
+    try:
+        if pdfium is not None:
+            pdf = _open_pdf_document(pdf_path)
+            bitmap = pdf[page_num].render(scale=2)
+            return bitmap.to_pil()
+
+        if convert_from_path is not None:
+            images = convert_from_path(
+                pdf_path, first_page=page_num + 1, last_page=page_num + 1
+            )
+            return images[0]
+
+        raise ImportError("Neither pypdfium2 nor pdf2image is installed")
+
+    except Exception as e:
+        raise Exception(f"Error converting PDF page to image: {str(e)}")
+
+def _init_cv_worker():
+    """Keep OpenCV single-threaded inside pool workers.
+
+    The pool already provides one worker per core; letting each worker's
+    OpenCV calls also spin up a thread per core oversubscribes the machine.
+    """
+    cv2.setNumThreads(1)
+
+# Pages whose background varies less than this are thresholded globally
+_UNIFORM_BG_STD = 20.0
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _fused_std(sample):
+        """One-pass standard deviation; Numba fuses the reductions"""
+        total = 0.0
+        total_sq = 0.0
+        for i in range(sample.shape[0]):
+            for j in range(sample.shape[1]):
+                value = float(sample[i, j])
+                total += value
+                total_sq += value * value
+        n = sample.shape[0] * sample.shape[1]
+        mean = total / n
+        return (total_sq / n - mean * mean) ** 0.5
+
+def _page_background_std(gray: np.ndarray) -> float:
+    """Estimate background variation from a downsampled view of the page"""
+    sample = gray[::8, ::8]
+    if numba is not None:
+        return _fused_std(sample)
+    return float(sample.std())
+
+# Per-worker scratch buffers keyed by role, reused across same-sized pages
+# so each page doesn't pay for fresh full-page allocations (pool workers
+# never share them across processes)
+_scratch_buffers: Dict[str, np.ndarray] = {}
+
+def _scratch_buffer(name: str, shape: Tuple[int, ...]) -> np.ndarray:
+    """Return this worker's reusable uint8 buffer for `name`, reallocating
+    only when the page size changes"""
+    buf = _scratch_buffers.get(name)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        _scratch_buffers[name] = buf
+    return buf
+
+def _render_page_gray(pdf_path: str, page_num: int) -> np.ndarray:
+    """Render a PDF page straight to a grayscale numpy array"""
+    if pdfium is not None:
+        pdf = _open_pdf_document(pdf_path)
+        bitmap = pdf[page_num].render(scale=2)
+        # View over the renderer's own buffer - no PIL round-trip, no copies
+        arr = bitmap.to_numpy()
+        code = cv2.COLOR_BGRA2GRAY if arr.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(arr, code, dst=_scratch_buffer('gray', arr.shape[:2]))
+
+    img = _convert_pdf_page_to_image(pdf_path, page_num)
+    arr = np.asarray(img)
+    return cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY,
+                        dst=_scratch_buffer('gray', arr.shape[:2]))
+
+def _process_single_page(pdf_path: str, page_num: int, output_dir: str) -> Dict:
+    """Process a single page of the PDF (top-level so it can be pickled for worker processes)"""
+    try:
+        # Render and threshold in grayscale end to end
+        gray = _render_page_gray(pdf_path, page_num)
+
+        # Clean scans with a flat background threshold just as well with a
+        # global Otsu cut, at a fraction of the adaptive kernel's cost
+        thresh_buf = _scratch_buffer('thresh', gray.shape)
+        if _page_background_std(gray) < _UNIFORM_BG_STD:
+            _, thresh = cv2.threshold(gray, 0, 255,
+                                      cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                                      dst=thresh_buf)
+        else:
+            thresh = cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY, 11, 2, dst=thresh_buf
+            )
+
+        # Save processed image; low compression level, deflate dominates
+        # the encode time otherwise
+        output_path = os.path.join(output_dir, f'page_{page_num+1}_processed.png')
+        cv2.imwrite(output_path, thresh, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+
+        return {
+            'page_number': page_num + 1,
+            'file_path': output_path
+        }
+
+    except Exception as e:
+        return {
+            'page_number': page_num + 1,
+            'error': str(e)
+        }
+
+def _process_vector_page(pdf_path: str, page_num: int) -> Dict:
+    """Extract text from a single vector page (top-level so it can be pickled for worker processes)"""
+    try:
+        # Extract text with error handling
+        try:
+            reader = _open_pdf_reader(pdf_path)
+            text = reader.pages[page_num].extract_text()
+            if text is None:
+                text = ""
+        except Exception as e:
+            print(f"Warning: Error extracting text from page {page_num + 1}: {str(e)}")
+            text = ""
+
+        return {
+            'page_number': page_num + 1,
+            'text': text,
+            'text_length': len(text)
+        }
+
+    except Exception as e:
+        print(f"Warning: Error processing page {page_num + 1}: {str(e)}")
+        return {
+            'page_number': page_num + 1,
+            'text': "",
+            'text_length': 0,
+            'error': str(e)
+        }
+
 class PDFProcessor:
-    def __init__(self, max_workers: int = 4, max_pages: Optional[int] = None):
-        self.raster_threshold = 0.95  # Threshold for determining if a PDF is raster-based
-        self.max_workers = max_workers
+    # How many leading pages to probe for text before calling a PDF a scan
+    detect_probe_pages = 5
+
+    def __init__(self, max_workers: Optional[int] = None, max_pages: Optional[int] = None):
+        self.max_workers = max_workers if max_workers is not None else _default_workers()
         self.max_pages = max_pages  # Maximum number of pages to process (None for all pages)
-        
-    def detect_pdf_type(self, pdf_path: str) -> str:
+
+    def detect_pdf_type(self, pdf_path: str, reader: Optional[PdfReader] = None) -> str:
         """
         Detect if a PDF is primarily raster-based or vector-based.
         Returns: 'raster' or 'vector'
         """
         try:
-            # First check if it's vector-based by looking for text
-            reader = PdfReader(pdf_path)
-            page = reader.pages[0]
-            
-            # If the page has text content, it's likely vector-based
-            if page.extract_text().strip():
-                return 'vector'
-            
-            # If no text found, check if it's raster-based
-            # Convert first page to image
-            img = self._convert_pdf_page_to_image(pdf_path)
-            
-            # Convert PIL image to OpenCV format
-            cv_img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            
-            # Calculate image statistics
-            edges = cv2.Canny(cv_img, 100, 200)
-            edge_density = np.count_nonzero(edges) / (edges.shape[0] * edges.shape[1])
-            
-            # If edge density is high, it's likely raster-based
-            if edge_density > self.raster_threshold:
-                return 'raster'
-            
-            return 'vector'
-            
+            # Check if it's vector-based by probing the first few pages for
+            # text; a single blank or title page shouldn't decide the type
+            if reader is None:
+                reader = PdfReader(_open_pdf_stream(pdf_path))
+
+            probe_pages = min(self.detect_probe_pages, len(reader.pages))
+            for page_num in range(probe_pages):
+                if reader.pages[page_num].extract_text().strip():
+                    return 'vector'
+
+            # No extractable text on any probe page - in practice that means
+            # a scanned document, so skip rendering anything and go raster
+            return 'raster'
+
         except Exception as e:
             raise Exception(f"Error detecting PDF type: {str(e)}")
     
-    def _convert_pdf_page_to_image(self, pdf_path: str, page_num: int = 0) -> Image.Image:
-        """Convert a PDF page to an image using PyPDF2 and Pillow"""
-        try:
-            reader = PdfReader(pdf_path)
-            page = reader.pages[page_num]
-            
-            # Get the page dimensions
-            width = float(page.mediabox.width)
-            height = float(page.mediabox.height)
-            
-            # Create a blank image with white background
-            img = Image.new('RGB', (int(width), int(height)), 'white')
-            
-            # Try to extract images from the page
-            for image in page.images:
-                try:
-                    image_data = image.data
-                    image_stream = io.BytesIO(image_data)
-                    page_image = Image.open(image_stream)
-                    img.paste(page_image, (0, 0))
-                except:
-                    continue
-            
-            return img
-            
-        except Exception as e:
-            raise Exception(f"Error converting PDF page to image: {str(e)}")
-    
-    def _process_single_page(self, pdf_path: str, page_num: int, output_dir: str) -> Dict:
-        """Process a single page of the PDF"""
-        try:
-            # Convert page to image
-            img = self._convert_pdf_page_to_image(pdf_path, page_num)
-            
-            # Convert to OpenCV format
-            cv_img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            
-            # Basic image processing
-            gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-            thresh = cv2.adaptiveThreshold(
-                gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                cv2.THRESH_BINARY, 11, 2
-            )
-            
-            # Save processed image
-            output_path = os.path.join(output_dir, f'page_{page_num+1}_processed.png')
-            cv2.imwrite(output_path, thresh)
-            
-            return {
-                'page_number': page_num + 1,
-                'file_path': output_path
-            }
-            
-        except Exception as e:
-            return {
-                'page_number': page_num + 1,
-                'error': str(e)
-            }
-    
-    def process_raster_pdf(self, pdf_path: str, output_dir: str) -> Dict:
+    def process_raster_pdf(self, pdf_path: str, output_dir: str,
+                           reader: Optional[PdfReader] = None) -> Dict:
         """
         Process raster-based PDFs using image processing techniques
         """
         try:
-            reader = PdfReader(pdf_path)
+            if reader is None:
+                reader = PdfReader(_open_pdf_stream(pdf_path))
             total_pages = len(reader.pages)
             
             # Limit the number of pages to process
@@ -122,17 +258,21 @@ class PDFProcessor:
             print(f"\nProcessing {pages_to_process} of {total_pages} pages as raster PDF...")
             start_time = time.time()
             
+            # Pre-size the list so results land at their page index regardless
+            # of completion order; failed pages stay None
             results = {
                 'total_pages': total_pages,
                 'pages_processed': pages_to_process,
-                'processed_images': []
+                'processed_images': [None] * pages_to_process
             }
             
-            # Process pages in parallel
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Process pages in parallel across processes (the work is CPU-bound,
+            # so threads would serialize on the GIL)
+            with ProcessPoolExecutor(max_workers=self.max_workers,
+                                     initializer=_init_cv_worker) as executor:
                 # Submit pages for processing
                 future_to_page = {
-                    executor.submit(self._process_single_page, pdf_path, i, output_dir): i
+                    executor.submit(_process_single_page, pdf_path, i, output_dir): i
                     for i in range(pages_to_process)
                 }
                 
@@ -141,7 +281,7 @@ class PDFProcessor:
                     for future in as_completed(future_to_page):
                         result = future.result()
                         if 'error' not in result:
-                            results['processed_images'].append(result['file_path'])
+                            results['processed_images'][result['page_number'] - 1] = result['file_path']
                         pbar.update(1)
             
             end_time = time.time()
@@ -154,80 +294,93 @@ class PDFProcessor:
         except Exception as e:
             raise Exception(f"Error processing raster PDF: {str(e)}")
     
-    def _process_vector_page(self, page, page_num: int, output_dir: str) -> Dict:
-        """Process a single vector page"""
-        try:
-            # Extract text with error handling
-            try:
-                text = page.extract_text()
-                if text is None:
-                    text = ""
-            except Exception as e:
-                print(f"Warning: Error extracting text from page {page_num + 1}: {str(e)}")
-                text = ""
-            
-            # Only save if there's actual text content
-            if text.strip():
-                try:
-                    output_path = os.path.join(output_dir, f'page_{page_num+1}_text.txt')
-                    with open(output_path, 'w', encoding='utf-8') as f:
-                        f.write(text)
-                except Exception as e:
-                    print(f"Warning: Error saving text for page {page_num + 1}: {str(e)}")
-            
-            return {
-                'page_number': page_num + 1,
-                'text': text,
-                'text_length': len(text)
-            }
-            
-        except Exception as e:
-            print(f"Warning: Error processing page {page_num + 1}: {str(e)}")
-            return {
-                'page_number': page_num + 1,
-                'text': "",
-                'text_length': 0,
-                'error': str(e)
-            }
-    
-    def process_vector_pdf(self, pdf_path: str, output_dir: str) -> Dict:
+    def process_vector_pdf(self, pdf_path: str, output_dir: str,
+                           reader: Optional[PdfReader] = None) -> Dict:
         """
         Process vector-based PDFs using PDF-specific techniques
         """
         try:
-            reader = PdfReader(pdf_path)
+            if reader is None:
+                reader = PdfReader(_open_pdf_stream(pdf_path))
             total_pages = len(reader.pages)
             
             print(f"\nExtracting text from {total_pages} pages...")
             start_time = time.time()
             
+            # Pre-size the list so pages land at their index regardless of
+            # completion order
             results = {
                 'total_pages': total_pages,
                 'pages_processed': total_pages,
-                'text_content': [],
+                'text_content': [""] * total_pages,
                 'metadata': reader.metadata,
                 'pages_with_text': 0,
                 'total_text_length': 0
             }
             
-            # Process pages in parallel
-            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                # Submit pages for processing
-                future_to_page = {
-                    executor.submit(self._process_vector_page, reader.pages[i], i, output_dir): i
-                    for i in range(total_pages)
-                }
-                
-                # Process results as they complete
-                with tqdm(total=total_pages, desc="Extracting text") as pbar:
-                    for future in as_completed(future_to_page):
-                        result = future.result()
-                        results['text_content'].append(result['text'])
-                        if result['text'].strip():
-                            results['pages_with_text'] += 1
-                            results['total_text_length'] += result['text_length']
-                        pbar.update(1)
-            
+            # Extracted text goes into one aggregate JSONL file instead of a
+            # small file per page. A dedicated writer thread drains a queue
+            # into a single buffered handle, so writing overlaps with
+            # collecting the next page instead of blocking it
+            pages_path = os.path.join(output_dir, 'pages.jsonl')
+            write_queue: "queue.Queue[Optional[bytes]]" = queue.Queue()
+            writer_errors: List[Exception] = []
+
+            def _write_pages():
+                try:
+                    with open(pages_path, 'wb', buffering=1 << 20) as pages_file:
+                        while True:
+                            line = write_queue.get()
+                            if line is None:
+                                break
+                            pages_file.write(line)
+                except Exception as e:
+                    # Surface the failure after join(); drain whatever is
+                    # queued so it doesn't grow unbounded while the loop
+                    # finishes. The drain must not block: if the failure came
+                    # from the close/flush after the sentinel was consumed,
+                    # the queue is already empty
+                    writer_errors.append(e)
+                    while True:
+                        try:
+                            write_queue.get_nowait()
+                        except queue.Empty:
+                            break
+
+            writer = threading.Thread(target=_write_pages)
+            writer.start()
+
+            # Process pages in parallel across processes; workers only receive
+            # (path, page index) so nothing unpicklable crosses the boundary
+            try:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    # Submit pages for processing
+                    future_to_page = {
+                        executor.submit(_process_vector_page, pdf_path, i): i
+                        for i in range(total_pages)
+                    }
+
+                    # Process results as they complete
+                    with tqdm(total=total_pages, desc="Extracting text") as pbar:
+                        for future in as_completed(future_to_page):
+                            result = future.result()
+                            results['text_content'][result['page_number'] - 1] = result['text']
+                            if result['text'].strip():
+                                results['pages_with_text'] += 1
+                                results['total_text_length'] += result['text_length']
+                                write_queue.put(_dump_json_bytes(
+                                    {'page': result['page_number'], 'text': result['text']}
+                                ) + b'\n')
+                            pbar.update(1)
+            finally:
+                write_queue.put(None)
+                writer.join()
+
+            # A dead writer means pages.jsonl is missing or partial; fail the
+            # PDF rather than report every page as saved
+            if writer_errors:
+                raise writer_errors[0]
+
             end_time = time.time()
             processing_time = end_time - start_time
             print(f"\nText extraction completed in {processing_time:.2f} seconds")
@@ -247,15 +400,18 @@ class PDFProcessor:
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
         
+        # Parse the PDF once and share the reader across detection and processing
+        reader = PdfReader(_open_pdf_stream(pdf_path))
+
         print("Detecting PDF type...")
         # Detect PDF type
-        pdf_type = self.detect_pdf_type(pdf_path)
+        pdf_type = self.detect_pdf_type(pdf_path, reader)
         print(f"PDF type detected: {pdf_type}")
-        
+
         # Process based on type
         if pdf_type == 'raster':
-            results = self.process_raster_pdf(pdf_path, output_dir)
+            results = self.process_raster_pdf(pdf_path, output_dir, reader)
         else:
-            results = self.process_vector_pdf(pdf_path, output_dir)
+            results = self.process_vector_pdf(pdf_path, output_dir, reader)
         
         return pdf_type, results 
\ No newline at end of file